@@ -4,8 +4,9 @@ import uuid
 import requests
 import streamlit as st
 import boto3
-from botocore.exceptions import NoCredentialsError, ClientError
+from botocore.exceptions import NoCredentialsError, ClientError, BotoCoreError
 from dotenv import load_dotenv
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
 import sib_api_v3_sdk
 from sib_api_v3_sdk.rest import ApiException
@@ -16,6 +17,8 @@ load_dotenv()
 st.set_page_config(page_title="Smriti | Client Portal", page_icon=":keys:", layout="centered")
 st.title("Smriti :) Client Portal")
 
+PHOTO_EXTENSIONS = frozenset({".jpg", ".jpeg", ".png"})
+
 
 @st.cache_resource
 def get_s3_client():
@@ -31,6 +34,20 @@ def get_s3_client():
         st.error("S3 credentials not found. Please contact the administrator.")
         return None
 
+@st.cache_resource
+def get_rekognition_client():
+    """Initializes and caches the Rekognition client."""
+    try:
+        return boto3.client(
+            "rekognition",
+            aws_access_key_id=st.secrets["aws"]["access_key_id"],
+            aws_secret_access_key=st.secrets["aws"]["secret_access_key"],
+            region_name=st.secrets["aws"]["s3_region"],
+        )
+    except (KeyError, NoCredentialsError):
+        st.error("Rekognition credentials not found. Please contact the administrator.")
+        return None
+
 def send_welcome_email(recipient_email: str, client_passkey: str, user_passkey: str) -> None:
     """Sends the onboarding email using Brevo."""
     try:
@@ -107,6 +124,54 @@ def upload_file(s3_client, bucket: str, s3_key: str, uploaded_file) -> requests.
     files = {'file': (s3_key, uploaded_file, content_type)}
     return requests.post(presigned_post['url'], data=presigned_post['fields'], files=files, timeout=120)
 
+def ensure_collection(rekognition_client, collection_id: str) -> None:
+    """Creates the event's Rekognition collection if it doesn't exist yet."""
+    try:
+        rekognition_client.describe_collection(CollectionId=collection_id)
+    except rekognition_client.exceptions.ResourceNotFoundException:
+        rekognition_client.create_collection(CollectionId=collection_id)
+
+def register_photo(db_session: Session, client_id: int, s3_key: str) -> PhotosDB:
+    """Returns the DB row for an uploaded photo, creating it if needed."""
+    try:
+        photo = db_session.query(PhotosDB).filter_by(client_id=client_id, s3_key=s3_key).first()
+        if not photo:
+            photo = PhotosDB(client_id=client_id, s3_key=s3_key, is_highlighted=False)
+            db_session.add(photo)
+            db_session.commit()
+            db_session.refresh(photo)
+    except SQLAlchemyError:
+        db_session.rollback()
+        raise
+    return photo
+
+def index_photo_faces(rekognition_client, bucket: str, photo: PhotosDB, collection_id: str) -> int:
+    """Indexes every face in an uploaded photo so guests can find it with one search.
+
+    S3 keys contain '/', which Rekognition rejects in ExternalImageId, so faces
+    are tagged with the photo's row id and mapped back to the key on search.
+    """
+    if os.path.splitext(photo.s3_key)[1].lower() not in PHOTO_EXTENSIONS:
+        return 0
+    resp = rekognition_client.index_faces(
+        CollectionId=collection_id,
+        Image={"S3Object": {"Bucket": bucket, "Name": photo.s3_key}},
+        ExternalImageId=str(photo.id),
+        QualityFilter="AUTO",
+    )
+    return len(resp.get("FaceRecords", []))
+
+def get_indexed_photo_ids(rekognition_client, collection_id: str) -> set[int]:
+    """Collects the ids of photos that already have faces in the event's collection."""
+    indexed_ids = set()
+    paginator = rekognition_client.get_paginator("list_faces")
+    for page in paginator.paginate(CollectionId=collection_id):
+        for face in page.get("Faces", []):
+            external_id = face.get("ExternalImageId", "")
+            if external_id.isdigit():
+                indexed_ids.add(int(external_id))
+    return indexed_ids
+
 @st.cache_data(ttl=600)
 def list_all_s3_photos(_s3_client, bucket: str, folder: str):
     """Lists all image files in a specific S3 folder. Caches for 10 minutes."""
@@ -116,7 +181,7 @@ def list_all_s3_photos(_s3_client, bucket: str, folder: str):
         if "Contents" in page:
             for obj in page["Contents"]:
                 key = obj["Key"]
-                if key.lower().endswith(('png', 'jpg', 'jpeg')):
+                if os.path.splitext(key)[1].lower() in PHOTO_EXTENSIONS:
                     s3_keys.append(key)
     return s3_keys
 
@@ -192,6 +257,8 @@ elif st.session_state.auth_step == "passkey_verification":
 elif st.session_state.auth_step == "uploader":
     client = st.session_state.current_client
     s3_client = get_s3_client()
+    rekognition_client = get_rekognition_client()
+    if not s3_client or not rekognition_client: st.stop()
     S3_BUCKET = st.secrets["aws"]["s3_bucket_name"]
 
     st.header(f"Manage Event for {client.email}")
@@ -211,6 +278,12 @@ elif st.session_state.auth_step == "uploader":
             success_count = 0
             error_count = 0
             progress_bar = st.progress(0, text="Preparing uploads...")
+            try:
+                ensure_collection(rekognition_client, client.rekognition_collection_id)
+            except ClientError as e:
+                progress_bar.empty()
+                st.error(f"Could not prepare the guest search index. Please contact the administrator. Error: {e}")
+                st.stop()
 
             for i, uploaded_file in enumerate(uploaded_files, 1):
                 try:
@@ -218,7 +291,12 @@ elif st.session_state.auth_step == "uploader":
                     with st.spinner(f"Uploading {os.path.basename(s3_key)}..."):
                         response = upload_file(s3_client, S3_BUCKET, s3_key, uploaded_file)
                     if response.status_code in [200, 204]:
+                        photo = register_photo(db, client.id, s3_key)
                         success_count += 1
+                        try:
+                            index_photo_faces(rekognition_client, S3_BUCKET, photo, client.rekognition_collection_id)
+                        except (ClientError, BotoCoreError) as e:
+                            st.warning(f"{os.path.basename(s3_key)} was uploaded but could not be indexed for guest search: {e}")
                     else:
                         st.error(f"Upload failed for {os.path.basename(s3_key)} (HTTP {response.status_code}).")
                         error_count += 1
@@ -233,6 +311,39 @@ elif st.session_state.auth_step == "uploader":
             if error_count > 0:
                 st.error(f"{error_count} photos failed to upload.")
 
+        st.subheader("Guest Search Index")
+        st.caption("Photos uploaded before guest search used indexing are not searchable yet. Run this once to index them. Photos that already have faces indexed are skipped; photos with no detectable face are re-checked on each run.")
+        if st.button("Index Existing Photos", use_container_width=True):
+            existing_photos = list_all_s3_photos(s3_client, S3_BUCKET, client.s3_folder_path)
+            if not existing_photos:
+                st.info("No photos found to index.")
+            else:
+                indexed_count = 0
+                error_count = 0
+                progress_bar = st.progress(0, text="Checking the guest search index...")
+                try:
+                    ensure_collection(rekognition_client, client.rekognition_collection_id)
+                    indexed_ids = get_indexed_photo_ids(rekognition_client, client.rekognition_collection_id)
+                except ClientError as e:
+                    progress_bar.empty()
+                    st.error(f"Could not read the guest search index. Please contact the administrator. Error: {e}")
+                    st.stop()
+
+                for i, s3_key in enumerate(existing_photos, 1):
+                    try:
+                        photo = register_photo(db, client.id, s3_key)
+                        if photo.id not in indexed_ids and index_photo_faces(rekognition_client, S3_BUCKET, photo, client.rekognition_collection_id) > 0:
+                            indexed_count += 1
+                    except Exception as e:
+                        st.error(f"Could not index {os.path.basename(s3_key)}: {e}")
+                        error_count += 1
+                    progress_bar.progress(i / len(existing_photos), text=f"Indexed {i}/{len(existing_photos)} photos")
+
+                progress_bar.empty()
+                st.success(f"Guest search index is up to date. {indexed_count} photos were newly indexed.")
+                if error_count > 0:
+                    st.error(f"{error_count} photos could not be indexed.")
+
 
     with tab2:
         st.subheader("Select Photos for Guest Slideshow")
@@ -31,7 +31,7 @@ class PhotosDB(Base):
     s3_key = Column(String, index=True, nullable=False)
     is_highlighted = Column(Boolean, default=False, nullable=False)
     
-    client_id = Column(Integer, ForeignKey("clients.id"), nullable=False)
+    client_id = Column(Integer, ForeignKey("clients.id"), index=True, nullable=False)
     client = relationship("ClientDB", back_populates="photos")
 
 
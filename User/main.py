@@ -1,12 +1,21 @@
 import os
 import io
-import time
+import math
+import html
+import json
+import hashlib
+import shutil
 import zipfile
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
+import streamlit.components.v1 as components
 import boto3
+from botocore.config import Config
 from botocore.exceptions import NoCredentialsError, ClientError
 from dotenv import load_dotenv
+from PIL import Image
+from sqlalchemy import func, or_
 from sqlalchemy.orm import Session
 
 from database import SessionLocal, ClientDB, PhotosDB, create_db_and_tables
@@ -14,18 +23,26 @@ from database import SessionLocal, ClientDB, PhotosDB, create_db_and_tables
 load_dotenv()
 st.set_page_config(page_title="Smriti | Finding Your Precious Moments", page_icon=":sparkles:", layout="centered")
 
-BATCH_SIZE = 25
 MAX_WORKERS = 8
 FACE_MATCH_THRESHOLD = 90
+SEARCH_MAX_FACES = 4096
 SELFIE_EXTERNAL_ID = "selfie_user_runtime"
+SELFIE_MAX_SIZE = (640, 640)
+SELFIE_JPEG_QUALITY = 85
 SLIDESHOW_DELAY_SECONDS = 4
+SLIDESHOW_HEIGHT = 500
+ZIP_CHUNK_SIZE = 64 * 1024
+RESULTS_PAGE_SIZE = 40
+PRESIGNED_URL_EXPIRY_SECONDS = 3600
+PHOTO_EXTENSIONS = frozenset({".jpg", ".jpeg", ".png"})
 
 @st.cache_resource
 def make_clients():
     """Initializes and caches AWS clients."""
+    config = Config(retries={"mode": "adaptive", "max_attempts": 10}, max_pool_connections=MAX_WORKERS * 2)
     try:
-        s3 = boto3.client("s3", aws_access_key_id=st.secrets["aws"]["access_key_id"], aws_secret_access_key=st.secrets["aws"]["secret_access_key"], region_name=st.secrets["aws"]["s3_region"])
-        rekog = boto3.client("rekognition", aws_access_key_id=st.secrets["aws"]["access_key_id"], aws_secret_access_key=st.secrets["aws"]["secret_access_key"], region_name=st.secrets["aws"]["s3_region"])
+        s3 = boto3.client("s3", aws_access_key_id=st.secrets["aws"]["access_key_id"], aws_secret_access_key=st.secrets["aws"]["secret_access_key"], region_name=st.secrets["aws"]["s3_region"], config=config)
+        rekog = boto3.client("rekognition", aws_access_key_id=st.secrets["aws"]["access_key_id"], aws_secret_access_key=st.secrets["aws"]["secret_access_key"], region_name=st.secrets["aws"]["s3_region"], config=config)
         return s3, rekog
     except (KeyError, NoCredentialsError):
         st.error("Keys error contact the event host")
@@ -34,10 +51,33 @@ def make_clients():
 s3_client, rekognition = make_clients()
 S3_BUCKET_NAME = st.secrets["aws"]["s3_bucket_name"]
 
+@st.cache_data(ttl=PRESIGNED_URL_EXPIRY_SECONDS - 100, show_spinner=False)
+def get_presigned_url(key: str, expires: int = PRESIGNED_URL_EXPIRY_SECONDS):
+    """Signs a GET URL for an S3 key; cached for slightly less than its expiry so reruns never re-sign."""
+    return s3_client.generate_presigned_url("get_object", Params={"Bucket": S3_BUCKET_NAME, "Key": key}, ExpiresIn=expires)
+
+@st.cache_resource
+def get_executor():
+    """Creates and caches the thread pool used for parallel S3 downloads."""
+    return ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="s3-zip")
+
+@st.cache_resource
+def init_db():
+    """Creates the database tables once per process instead of on every rerun."""
+    create_db_and_tables()
+    return True
+
+@st.cache_data(ttl=600, show_spinner=False)
+def lookup_client(passkey_hash: str, _passkey: str):
+    """Finds the client for a user passkey; cached on the passkey's hash so the cleartext is never a cache key."""
+    with SessionLocal() as db_session:
+        return db_session.query(ClientDB).filter(ClientDB.user_passkey == _passkey).first()
+
 @st.cache_data(ttl=600, show_spinner="Fetching event highlights...")
-def get_highlighted_photos(_db_session: Session, client_id: int):
+def get_highlighted_photos(client_id: int):
     """Fetches a list of S3 keys for highlighted photos from the database."""
-    highlighted_photos = _db_session.query(PhotosDB.s3_key).filter_by(client_id=client_id, is_highlighted=True).all()
+    with SessionLocal() as db_session:
+        highlighted_photos = db_session.query(PhotosDB.s3_key).filter_by(client_id=client_id, is_highlighted=True).all()
     return [p.s3_key for p in highlighted_photos]
 
 def ensure_collection(collection_id: str):
@@ -46,78 +86,116 @@ def ensure_collection(collection_id: str):
     except rekognition.exceptions.ResourceNotFoundException:
         rekognition.create_collection(CollectionId=collection_id)
 
-def purge_faces_with_external_id(collection_id: str, external_id: str):
-    faces_to_delete = []
-    paginator = rekognition.get_paginator('list_faces')
-    for page in paginator.paginate(CollectionId=collection_id):
-        for face in page.get("Faces", []):
-            if face.get("ExternalImageId") == external_id:
-                faces_to_delete.append(face["FaceId"])
-    if faces_to_delete:
-        rekognition.delete_faces(CollectionId=collection_id, FaceIds=faces_to_delete)
+@st.cache_resource(show_spinner=False)
+def ensure_collection_once(collection_id: str):
+    """Checks the collection exists once per process, sparing a describe_collection call on every search."""
+    ensure_collection(collection_id)
+    return True
+
+def delete_selfie_face(collection_id: str, face_id: str):
+    """Removes the guest's selfie from the collection as soon as the search is done."""
+    try:
+        rekognition.delete_faces(CollectionId=collection_id, FaceIds=[face_id])
+    except ClientError:
+        st.warning("Your selfie could not be removed from the event's search index. Please let the event host know.")
+
+def prepare_selfie(selfie_file) -> bytes:
+    """Downscales the camera capture to a small JPEG; Rekognition only needs an 80x80 face region."""
+    img = Image.open(selfie_file).convert("RGB")
+    img.thumbnail(SELFIE_MAX_SIZE)
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=SELFIE_JPEG_QUALITY, optimize=True)
+    return buf.getvalue()
 
 def index_selfie(selfie_bytes: bytes, collection_id: str, external_id: str):
     resp = rekognition.index_faces(CollectionId=collection_id, Image={"Bytes": selfie_bytes}, ExternalImageId=external_id, MaxFaces=1, QualityFilter="AUTO")
-    return len(resp.get("FaceRecords", [])) > 0
-
-@st.cache_data(ttl=3600, show_spinner=False)
-def list_all_s3_photos(_bucket: str, _folder: str):
-    paginator = s3_client.get_paginator("list_objects_v2")
-    keys = []
-    for page in paginator.paginate(Bucket=_bucket, Prefix=_folder):
-        for obj in page.get("Contents", []):
-            key = obj["Key"]
-            if key.lower().endswith((".jpg", ".jpeg", ".png")):
-                keys.append(key)
-    return keys
-
-def search_faces_with_retry(bucket: str, key: str, collection_id: str, max_retries: int = 3):
-    delay = 0.25
-    for _ in range(max_retries):
-        try:
-            resp = rekognition.search_faces_by_image(CollectionId=collection_id, Image={"S3Object": {"Bucket": bucket, "Name": key}}, FaceMatchThreshold=FACE_MATCH_THRESHOLD, MaxFaces=5)
-            return resp.get("FaceMatches", [])
-        except ClientError as e:
-            if e.response['Error']['Code'] in ('ProvisionedThroughputExceededException', 'ThrottlingException'):
-                time.sleep(delay)
-                delay *= 2
-            else: return []
-    return []
-
-def process_batch_parallel(batch_keys, bucket, collection_id):
-    matches = []
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        future_to_key = {executor.submit(search_faces_with_retry, bucket, key, collection_id): key for key in batch_keys}
-        for future in as_completed(future_to_key):
-            if future.result():
-                matches.append(future_to_key[future])
-    return matches
+    records = resp.get("FaceRecords", [])
+    return records[0]["Face"]["FaceId"] if records else None
+
+def count_event_photos(db_session: Session, client_id: int) -> int:
+    """Counts the event's photos in a format Rekognition can index."""
+    s3_key = func.lower(PhotosDB.s3_key)
+    return db_session.query(PhotosDB.id).filter(PhotosDB.client_id == client_id, or_(*(s3_key.like(f"%{ext}") for ext in PHOTO_EXTENSIONS))).count()
+
+def search_photos_for_face(collection_id: str, face_id: str) -> set[int]:
+    """Returns the ids of indexed photos containing the given face, in a single Rekognition call."""
+    resp = rekognition.search_faces(CollectionId=collection_id, FaceId=face_id, FaceMatchThreshold=FACE_MATCH_THRESHOLD, MaxFaces=SEARCH_MAX_FACES)
+    external_ids = (m["Face"].get("ExternalImageId", "") for m in resp.get("FaceMatches", []))
+    return {int(e) for e in external_ids if e.isdigit()}
+
+def get_photo_keys(db_session: Session, client_id: int, photo_ids: set[int]) -> set[str]:
+    """Maps photo ids returned by Rekognition back to their S3 keys."""
+    if not photo_ids:
+        return set()
+    photos = db_session.query(PhotosDB.s3_key).filter(PhotosDB.client_id == client_id, PhotosDB.id.in_(photo_ids)).all()
+    return {p.s3_key for p in photos}
 
 def build_zip_for_keys(bucket: str, keys: list[str]) -> io.BytesIO:
+    """Streams each S3 object into the archive in chunks, fetching the next MAX_WORKERS objects in parallel."""
     buff = io.BytesIO()
-    with zipfile.ZipFile(buff, "a", zipfile.ZIP_DEFLATED, False) as zf:
-        for k in keys:
+    remaining = iter(keys)
+    pending = deque()
+    executor = get_executor()
+    with zipfile.ZipFile(buff, "w", zipfile.ZIP_STORED, allowZip64=True) as zf:
+        def prefetch_next():
+            k = next(remaining, None)
+            if k is not None:
+                pending.append((k, executor.submit(s3_client.get_object, Bucket=bucket, Key=k)))
+
+        for _ in range(MAX_WORKERS):
+            prefetch_next()
+        while pending:
+            k, future = pending.popleft()
+            prefetch_next()
             try:
-                obj = s3_client.get_object(Bucket=bucket, Key=k)
-                zf.writestr(os.path.basename(k), obj["Body"].read())
+                obj = future.result()
+                with obj["Body"] as body, zf.open(os.path.basename(k), "w", force_zip64=True) as dst:
+                    shutil.copyfileobj(body, dst, ZIP_CHUNK_SIZE)
             except ClientError: continue
-    buff.seek(0)
     return buff
 
+def build_slideshow_html(urls: list[str]) -> str:
+    """Builds a self-contained carousel that advances in the browser, so the server stays idle during the slideshow."""
+    urls_js = json.dumps(urls).replace("</", "<\\/")
+    return f"""
+    <style>
+      body {{ margin: 0; font-family: sans-serif; }}
+      #slide {{ width: 100%; height: {SLIDESHOW_HEIGHT - 40}px; object-fit: contain; animation: fadeIn 2.0s; }}
+      #caption {{ text-align: center; color: #808495; font-size: 14px; padding-top: 8px; }}
+      @keyframes fadeIn {{ 0% {{ opacity: 0; }} 100% {{ opacity: 1; }} }}
+    </style>
+    <img id="slide" src="{html.escape(urls[0])}">
+    <div id="caption">Highlight 1 of {len(urls)}</div>
+    <script>
+      const urls = {urls_js};
+      urls.forEach(u => {{ new Image().src = u; }});
+      const slide = document.getElementById("slide");
+      const caption = document.getElementById("caption");
+      let i = 0;
+      setInterval(() => {{
+        i = (i + 1) % urls.length;
+        slide.style.animation = "none";
+        void slide.offsetHeight;
+        slide.style.animation = "";
+        slide.src = urls[i];
+        caption.textContent = `Highlight ${{i + 1}} of ${{urls.length}}`;
+      }}, {SLIDESHOW_DELAY_SECONDS * 1000});
+    </script>
+    """
+
 st.title("Smriti :) Find your moments")
 
-for key, default in [("passkey_verified", False), ("current_client", None), ("search_active", False), ("all_photo_keys", []), ("matched_s3_keys", []), ("processed_index", 0), ("slideshow_index", 0), ("slideshow_complete", False)]:
+for key, default in [("passkey_verified", False), ("current_client", None), ("search_active", False), ("matched_s3_keys", set()), ("matched_zip", None), ("slideshow_complete", False)]:
     if key not in st.session_state: st.session_state[key] = default
 
-db: Session = SessionLocal()
-create_db_and_tables()
+init_db()
 
 if not st.session_state.passkey_verified:
     st.header("Event Access")
     passkey_input = st.text_input("Please enter the User Passkey provided by the event host:", type="password")
     if st.button("Access Photos"):
         if passkey_input:
-            client = db.query(ClientDB).filter(ClientDB.user_passkey == passkey_input).first()
+            client = lookup_client(hashlib.sha256(passkey_input.encode()).hexdigest(), passkey_input)
             if client:
                 st.session_state.passkey_verified = True
                 st.session_state.current_client = client
@@ -129,40 +207,23 @@ if not st.session_state.passkey_verified:
     st.stop()
 
 client_config = st.session_state.current_client
-highlight_keys = get_highlighted_photos(db, client_config.id)
+highlight_keys = get_highlighted_photos(client_config.id)
 
 if not st.session_state.slideshow_complete and highlight_keys:
     st.header(":sparkles: Event Highlights")
     
-    st.markdown("""<style> @keyframes fadeIn { 0% { opacity: 0; } 100% { opacity: 1; } } .slideshow-image { animation: fadeIn 2.0s; } </style>""", unsafe_allow_html=True)
+    components.html(build_slideshow_html([get_presigned_url(k) for k in highlight_keys]), height=SLIDESHOW_HEIGHT)
 
-    slideshow_placeholder = st.empty()
-    
     if st.button("Skip to Photo Search →", use_container_width=True):
         st.session_state.slideshow_complete = True
         st.rerun()
-        
-    idx = st.session_state.slideshow_index
-    
-    with slideshow_placeholder.container():
-        key = highlight_keys[idx]
-        url = s3_client.generate_presigned_url("get_object", Params={"Bucket": S3_BUCKET_NAME, "Key": key}, ExpiresIn=60)
-        st.image(url, caption=f"Highlight {idx + 1} of {len(highlight_keys)}", use_container_width=True)
-        st.markdown('<div class="slideshow-image"></div>', unsafe_allow_html=True)
-    
-    st.session_state.slideshow_index = (idx + 1) % len(highlight_keys)
-    
-    time.sleep(SLIDESHOW_DELAY_SECONDS)
-    st.rerun()
 
 if st.session_state.slideshow_complete or not highlight_keys:
-    S3_WEDDING_PHOTOS_FOLDER = client_config.s3_folder_path
     COLLECTION_ID = client_config.rekognition_collection_id
 
     if highlight_keys:
         if st.button("↩ Replay Highlights"):
             st.session_state.slideshow_complete = False
-            st.session_state.slideshow_index = 0
             st.rerun()
 
     st.markdown("---")
@@ -173,53 +234,61 @@ if st.session_state.slideshow_complete or not highlight_keys:
     start_disabled = not (selfie_picture and s3_client and rekognition)
     if st.button("Start Search", type="primary", use_container_width=True, disabled=start_disabled):
         st.session_state.search_active = True
-        st.session_state.matched_s3_keys = []
-        st.session_state.processed_index = 0
-
-        with st.spinner("Preparing..."):
-            ensure_collection(COLLECTION_ID)
-            purge_faces_with_external_id(COLLECTION_ID, SELFIE_EXTERNAL_ID)
-            if not index_selfie(selfie_picture.getvalue(), COLLECTION_ID, SELFIE_EXTERNAL_ID):
-                st.error("No face detected in the selfie. Please try again with better lighting.")
-                st.session_state.search_active = False
-                st.stop()
-            st.session_state.all_photo_keys = list_all_s3_photos(S3_BUCKET_NAME, S3_WEDDING_PHOTOS_FOLDER)
-            if not st.session_state.all_photo_keys:
+        st.session_state.matched_s3_keys = set()
+        st.session_state.matched_zip = None
+
+        with st.status("Preparing...", expanded=False) as status:
+            ensure_collection_once(COLLECTION_ID)
+            with SessionLocal() as db:
+                photo_count = count_event_photos(db, client_config.id)
+            if not photo_count:
+                status.update(label="No images found", state="error", expanded=True)
                 st.warning("No images found in storage. Please contact the event host.")
                 st.session_state.search_active = False
                 st.stop()
 
-    total = len(st.session_state.all_photo_keys)
-    if st.session_state.search_active and st.session_state.processed_index < total:
-        start = st.session_state.processed_index
-        end = min(start + BATCH_SIZE, total)
-
-        st.progress(start / total, text=f"Analyzing photos... ({start} / {total})")
-        batch_keys = st.session_state.all_photo_keys[start:end]
-        batch_matches = process_batch_parallel(batch_keys, S3_BUCKET_NAME, COLLECTION_ID)
-
-        if batch_matches:
-            st.session_state.matched_s3_keys = sorted(set(st.session_state.matched_s3_keys).union(batch_matches))
+            selfie_face_id = index_selfie(prepare_selfie(selfie_picture), COLLECTION_ID, SELFIE_EXTERNAL_ID)
+            if not selfie_face_id:
+                status.update(label="No face detected", state="error", expanded=True)
+                st.error("No face detected in the selfie. Please try again with better lighting.")
+                st.session_state.search_active = False
+                st.stop()
 
-        st.session_state.processed_index = end
-        st.rerun()
+            try:
+                status.update(label=f"Analyzing {photo_count} photos...")
+                try:
+                    matched_ids = search_photos_for_face(COLLECTION_ID, selfie_face_id)
+                except ClientError as e:
+                    status.update(label="Search failed", state="error", expanded=True)
+                    st.error(f"The photo search failed. Please try again or contact the event host. Error: {e.response['Error']['Message']}")
+                    st.session_state.search_active = False
+                    st.stop()
+                with SessionLocal() as db:
+                    st.session_state.matched_s3_keys.update(get_photo_keys(db, client_config.id, matched_ids))
+            finally:
+                delete_selfie_face(COLLECTION_ID, selfie_face_id)
+            status.update(label="Search complete", state="complete")
 
     if st.session_state.matched_s3_keys:
         st.set_page_config(layout="wide")
-        st.header(f"Found you in {len(st.session_state.matched_s3_keys)} photos!")
-        zip_buffer = build_zip_for_keys(S3_BUCKET_NAME, st.session_state.matched_s3_keys)
-        st.download_button(label="Download All Matched Moments (.zip)", data=zip_buffer, file_name="smriti_matched_moments.zip", mime="application/zip", use_container_width=True)
+        sorted_keys = sorted(st.session_state.matched_s3_keys)
+        st.header(f"Found you in {len(sorted_keys)} photos!")
+        if st.session_state.matched_zip is None:
+            st.session_state.matched_zip = build_zip_for_keys(S3_BUCKET_NAME, sorted_keys).getvalue()
+        st.download_button(label="Download All Matched Moments (.zip)", data=st.session_state.matched_zip, file_name="smriti_matched_moments.zip", mime="application/zip", use_container_width=True)
         
+        page_count = math.ceil(len(sorted_keys) / RESULTS_PAGE_SIZE)
+        page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, step=1) if page_count > 1 else 1
+        visible_keys = sorted_keys[(page - 1) * RESULTS_PAGE_SIZE : page * RESULTS_PAGE_SIZE]
+
         cols = st.columns(4)
-        for i, key in enumerate(st.session_state.matched_s3_keys):
+        for i, key in enumerate(visible_keys):
             with cols[i % 4]:
-                url = s3_client.generate_presigned_url("get_object", Params={"Bucket": S3_BUCKET_NAME, "Key": key}, ExpiresIn=3600)
+                url = get_presigned_url(key)
                 st.image(url, caption=os.path.basename(key), use_container_width=True)
 
-    if st.session_state.search_active and st.session_state.processed_index >= total:
+    if st.session_state.search_active:
         st.success("All photos have been processed!")
         if not st.session_state.matched_s3_keys:
             st.info("No matches were found in the entire collection.")
         st.session_state.search_active = False
-
-db.close()